@@ -1,17 +1,253 @@
+import decimal
+import functools
+import io
 import os
 import logging
-from datetime import datetime
-import pandas as pd
+from datetime import datetime, timezone
+import orjson
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
 from sqlalchemy import create_engine, text
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+# Quantidade de linhas buscadas por vez no cursor do servidor
+FETCH_SIZE = 50_000
+
+# Extrações simultâneas no modo CLI (no Airflow o limite é o pool northwind_pg)
+EXTRACT_WORKERS = 4
+
+# Coluna usada como marca d'água nas extrações incrementais
+WATERMARK_COLUMN = 'modified_at'
+
+# Marcador gravado ao lado de cada arquivo extraído por completo
+SUCCESS_MARKER = '_SUCCESS'
+
+# Formatos aceitos para os arquivos intermediários entre extração e carga
+INTERMEDIATE_FORMATS = ('parquet', 'arrow')
+
+# Linhas por row group nos arquivos Parquet
+ROW_GROUP_SIZE = 500_000
+
+# Linhas enviadas por comando COPY na carga
+COPY_BATCH_SIZE = 100_000
+
+# Linhas por comando INSERT quando a carga não usa COPY
+INSERT_PAGE_SIZE = 10_000
+
+# Métodos de carga: COPY FROM STDIN ou INSERT em lotes (para quando o COPY não pode ser usado)
+LOAD_METHODS = ('copy', 'insert')
+
+# Motores para gerar os arquivos de resultado
+EXPORT_ENGINES = ('postgres', 'duckdb')
+
+# Junção que gera orders_complete, no Postgres ou no DuckDB
+ORDERS_COMPLETE_SELECT = """
+SELECT 
+    o.*,
+    d.product_id,
+    d.unit_price,
+    d.quantity,
+    d.discount
+FROM {orders} o
+JOIN {order_details} d ON o.order_id = d.order_id
+"""
+
+# Remove a view orders_complete criada pela versão original do pipeline, se ainda existir
+DROP_LEGACY_VIEW = """
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.views
+               WHERE table_schema = 'public' AND table_name = 'orders_complete') THEN
+        DROP VIEW IF EXISTS public.orders_complete;
+    END IF;
+END $$;
+"""
+
+# Bloco lido por vez do arquivo CSV
+CSV_BLOCK_SIZE = 64 << 20
+
+# Tabela fornecida pelo CSV; a tabela de mesmo nome no Postgres não é extraída nem carregada,
+# para que order_details_final tenha uma única origem
+CSV_TABLE = 'order_details'
+
+# Esquema do arquivo order_details.csv
+ORDER_DETAILS_SCHEMA = pa.schema([
+    ('order_id', pa.int32()),
+    ('product_id', pa.int32()),
+    ('unit_price', pa.float64()),
+    ('quantity', pa.int32()),
+    ('discount', pa.float64()),
+])
+
+# Tipos do Arrow para os OIDs do PostgreSQL cujo valor no psycopg2 já serve ao Arrow.
+# Os demais (uuid, json, jsonb, interval, arrays, numeric sem precisão...) chegam como texto
+POSTGRES_ARROW_TYPES = {
+    16: pa.bool_(),                        # boolean
+    17: pa.binary(),                       # bytea
+    20: pa.int64(),                        # bigint
+    21: pa.int16(),                        # smallint
+    23: pa.int32(),                        # integer
+    25: pa.string(),                       # text
+    700: pa.float32(),                     # real
+    701: pa.float64(),                     # double precision
+    1042: pa.string(),                     # char
+    1043: pa.string(),                     # varchar
+    1082: pa.date32(),                     # date
+    1083: pa.time64('us'),                 # time
+    1114: pa.timestamp('us'),              # timestamp
+    1184: pa.timestamp('us', tz='UTC'),    # timestamptz
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine(postgres_conn_string):
+    """Retorna o engine do processo para a string de conexão, criando-o uma única vez"""
+    return create_engine(postgres_conn_string, pool_size=EXTRACT_WORKERS, pool_pre_ping=True, future=True)
+
+
+@functools.lru_cache(maxsize=None)
+def get_table_metadata(postgres_conn_string):
+    """Obtém colunas e chave primária de todas as tabelas em uma única consulta, com cache por processo"""
+    # As tabelas geradas pelo próprio pipeline não são extraídas de novo
+    query = """
+    SELECT
+        c.table_name,
+        array_agg(CAST(c.column_name AS text) ORDER BY c.ordinal_position) AS columns,
+        array_agg(
+            CONCAT(c.data_type, '(', c.numeric_precision, ',', c.numeric_scale, ')')
+            ORDER BY c.ordinal_position
+        ) AS types,
+        array_remove(array_agg(CAST(k.column_name AS text) ORDER BY k.ordinal_position), NULL) AS primary_key
+    FROM information_schema.columns c
+    LEFT JOIN information_schema.table_constraints t
+        ON t.table_schema = c.table_schema
+       AND t.table_name = c.table_name
+       AND t.constraint_type = 'PRIMARY KEY'
+    LEFT JOIN information_schema.key_column_usage k
+        ON k.constraint_schema = t.constraint_schema
+       AND k.constraint_name = t.constraint_name
+       AND k.column_name = c.column_name
+    WHERE c.table_schema = 'public'
+      AND right(c.table_name, 6) <> '_final'
+      AND c.table_name <> 'orders_complete'
+    GROUP BY c.table_name
+    ORDER BY c.table_name
+    """
+    with get_engine(postgres_conn_string).connect() as conn:
+        return {
+            row.table_name: {
+                'columns': tuple(row.columns),
+                'types': tuple(row.types),
+                'primary_key': tuple(row.primary_key)
+            }
+            for row in conn.execute(text(query))
+        }
+
+
+def watermark_type(metadata):
+    """Retorna o tipo da coluna de marca d'água da tabela, ou uma string vazia se ela não existir"""
+    if WATERMARK_COLUMN not in metadata['columns']:
+        return ''
+    return metadata['types'][metadata['columns'].index(WATERMARK_COLUMN)]
+
+
+def watermark_has_time_zone(metadata):
+    """Indica se a coluna de marca d'água da tabela é timestamp com fuso horário"""
+    return watermark_type(metadata).startswith('timestamp with time zone')
+
+
+def arrow_type(column):
+    """Converte a descrição de uma coluna do psycopg2 para um tipo do Arrow, ou None se for lida como texto"""
+    if column.type_code == 1700:
+        # numeric sem precisão declarada vem com precisão 65535 e não cabe em um decimal fixo
+        if column.precision and column.precision <= 38:
+            return pa.decimal128(column.precision, column.scale or 0)
+        if column.precision and column.precision <= 76:
+            return pa.decimal256(column.precision, column.scale or 0)
+        return None
+    return POSTGRES_ARROW_TYPES.get(column.type_code)
+
+
+def postgres_type(type_):
+    """Converte um tipo do Arrow para o tipo de coluna equivalente no PostgreSQL"""
+    if pa.types.is_boolean(type_):
+        return 'boolean'
+    if pa.types.is_int8(type_) or pa.types.is_int16(type_) or pa.types.is_uint8(type_):
+        return 'smallint'
+    if pa.types.is_int32(type_) or pa.types.is_uint16(type_):
+        return 'integer'
+    if pa.types.is_integer(type_):
+        return 'bigint'
+    if pa.types.is_float16(type_) or pa.types.is_float32(type_):
+        return 'real'
+    if pa.types.is_floating(type_):
+        return 'double precision'
+    if pa.types.is_decimal(type_):
+        return f'numeric({type_.precision}, {type_.scale})'
+    if pa.types.is_date(type_):
+        return 'date'
+    if pa.types.is_timestamp(type_):
+        return 'timestamptz' if type_.tz else 'timestamp'
+    if pa.types.is_time(type_):
+        return 'time'
+    if pa.types.is_binary(type_) or pa.types.is_large_binary(type_):
+        return 'bytea'
+    return 'text'
+
+
+def json_default(value):
+    """Serializa no JSON os tipos que o orjson não conhece"""
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, bytes):
+        return value.hex()
+    raise TypeError(f"Tipo não serializável: {type(value).__name__}")
+
+
+def json_lines(batch):
+    """Gera uma linha JSON (NDJSON) para cada registro do lote"""
+    columns = batch.to_pydict()
+    names = list(columns)
+    for values in zip(*columns.values()):
+        yield orjson.dumps(dict(zip(names, values)), default=json_default, option=orjson.OPT_APPEND_NEWLINE)
+
+
+def copy_batch(batch):
+    """Prepara o lote para o COPY em CSV, convertendo bytea para hexadecimal"""
+    for i, field in enumerate(batch.schema):
+        if pa.types.is_binary(field.type) or pa.types.is_large_binary(field.type):
+            values = [None if value is None else '\\x' + value.hex() for value in batch.column(i).to_pylist()]
+            batch = batch.set_column(i, field.name, pa.array(values, type=pa.string()))
+    return batch
+
 class NorthwindETL:
-    def __init__(self, postgres_conn_string, csv_path, execution_date=None):
+    def __init__(self, postgres_conn_string, csv_path, execution_date=None,
+                 compression='zstd', compression_level=3, intermediate_format='parquet',
+                 load_method='copy', export_engine='postgres'):
+        if intermediate_format not in INTERMEDIATE_FORMATS:
+            raise ValueError(f"Formato intermediário inválido: {intermediate_format}")
+        if load_method not in LOAD_METHODS:
+            raise ValueError(f"Método de carga inválido: {load_method}")
+        if export_engine not in EXPORT_ENGINES:
+            raise ValueError(f"Motor de exportação inválido: {export_engine}")
         self.postgres_conn_string = postgres_conn_string
         self.csv_path = csv_path
         self.execution_date = execution_date or datetime.now().strftime('%Y-%m-%d')
+        self.compression = compression
+        self.compression_level = compression_level
+        self.intermediate_format = intermediate_format
+        self.load_method = load_method
+        self.export_engine = export_engine
+        self.engine = get_engine(postgres_conn_string)
         self.setup_logging()
         
     def setup_logging(self):
@@ -29,35 +265,245 @@ class NorthwindETL:
         self.logger = logging
         
     def get_all_tables(self):
-        """Obtém todas as tabelas do banco de dados Northwind"""
-        engine = create_engine(self.postgres_conn_string)
-        query = """
-        SELECT table_name 
-        FROM information_schema.tables 
-        WHERE table_schema = 'public'
-        """
-        with engine.connect() as conn:
-            tables = pd.read_sql(query, conn)
-        return tables['table_name'].tolist()
+        """Obtém todas as tabelas do banco de dados Northwind, exceto a fornecida pelo CSV"""
+        return [table for table in get_table_metadata(self.postgres_conn_string) if table != CSV_TABLE]
+    
+    def get_columns(self, table):
+        """Obtém as colunas da tabela na ordem de definição"""
+        return list(get_table_metadata(self.postgres_conn_string)[table]['columns'])
+    
+    def get_primary_key(self, table):
+        """Obtém as colunas da chave primária da tabela"""
+        metadata = get_table_metadata(self.postgres_conn_string).get(table)
+        return list(metadata['primary_key']) if metadata else []
+    
+    def is_incremental(self, table):
+        """Indica se a tabela tem marca d'água e chave primária para carga incremental"""
+        metadata = get_table_metadata(self.postgres_conn_string).get(table)
+        # Só um timestamp serve de marca d'água; com date ou inteiro a tabela é recarregada inteira
+        return (
+            metadata is not None
+            and watermark_type(metadata).startswith('timestamp')
+            and len(metadata['primary_key']) > 0
+        )
+    
+    def get_watermark(self, table):
+        """Obtém a marca d'água da última carga da tabela, se houver"""
+        # Só leitura: a tabela de estado é criada na primeira carga, não aqui
+        with self.engine.connect() as conn:
+            if conn.execute(text("SELECT to_regclass('etl.watermarks')")).scalar() is None:
+                return None
+            query = text("SELECT high_watermark, ddl_fingerprint FROM etl.watermarks WHERE table_name = :table")
+            row = conn.execute(query, {'table': table}).first()
+        if row is None:
+            return None
+        # Depois de uma mudança no DDL a tabela final não tem as mesmas colunas;
+        # a marca é ignorada para que a tabela seja extraída e recriada inteira
+        if row.ddl_fingerprint != self._ddl_fingerprint(table):
+            self.logger.info(f"DDL da tabela {table} mudou; a marca d'água anterior é ignorada")
+            return None
+        # Marcas de colunas sem fuso horário são guardadas como UTC e voltam sem fuso
+        watermark = row.high_watermark
+        metadata = get_table_metadata(self.postgres_conn_string)[table]
+        if not watermark_has_time_zone(metadata):
+            watermark = watermark.astimezone(timezone.utc).replace(tzinfo=None)
+        return watermark
+    
+    def _set_watermark(self, cursor, table, watermark):
+        """Avança a marca d'água da tabela na mesma transação da carga"""
+        if watermark.tzinfo is None:
+            watermark = watermark.replace(tzinfo=timezone.utc)
+        # Evita que cargas paralelas criem a tabela de estado ao mesmo tempo
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('etl.watermarks'))")
+        cursor.execute("CREATE SCHEMA IF NOT EXISTS etl")
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS etl.watermarks (
+            table_name text PRIMARY KEY,
+            high_watermark timestamptz NOT NULL,
+            ddl_fingerprint text NOT NULL,
+            updated_at timestamptz NOT NULL DEFAULT now()
+        )
+        """)
+        # Com um DDL novo a tabela foi recriada e a marca recomeça da carga completa
+        cursor.execute("""
+        INSERT INTO etl.watermarks (table_name, high_watermark, ddl_fingerprint)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (table_name) DO UPDATE
+        SET high_watermark = CASE
+                WHEN etl.watermarks.ddl_fingerprint = EXCLUDED.ddl_fingerprint
+                THEN GREATEST(etl.watermarks.high_watermark, EXCLUDED.high_watermark)
+                ELSE EXCLUDED.high_watermark
+            END,
+            ddl_fingerprint = EXCLUDED.ddl_fingerprint,
+            updated_at = now()
+        """, (table, watermark, self._ddl_fingerprint(table)))
+    
+    def _query_batches(self, conn, query, params=None):
+        """Executa a consulta com cursor no servidor e gera RecordBatches do Arrow"""
+        with conn.cursor(name="etl_extract") as cursor:
+            cursor.itersize = FETCH_SIZE
+            cursor.execute(query, params)
+            # Busca só a descrição das colunas, antes de converter qualquer linha
+            cursor.fetchmany(0)
+            names = [col.name for col in cursor.description]
+            mapped = [arrow_type(col) for col in cursor.description]
+            
+            # Colunas sem tipo equivalente recebem o texto do próprio Postgres, sem conversão no
+            # psycopg2, para que os tipos não dependam dos valores de cada lote
+            text_oids = {col.type_code for col, type_ in zip(cursor.description, mapped) if type_ is None}
+            if text_oids:
+                as_text = psycopg2.extensions.new_type(tuple(text_oids), "ETL_TEXT", lambda value, cur: value)
+                psycopg2.extensions.register_type(as_text, cursor)
+            raw_text = [col.type_code in text_oids for col in cursor.description]
+            types = [type_ or pa.string() for type_ in mapped]
+            
+            first = True
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not first and not rows:
+                    break
+                
+                columns = list(zip(*rows)) if rows else [[] for _ in names]
+                arrays = [
+                    # Um numeric com precisão também chega como texto se a consulta tiver outro sem
+                    pa.array(column, type=pa.string()).cast(type_) if is_text and not pa.types.is_string(type_)
+                    else pa.array(column, type=type_)
+                    for column, type_, is_text in zip(columns, types, raw_text)
+                ]
+                first = False
+                yield pa.RecordBatch.from_arrays(arrays, names=names)
+                
+                if not rows:
+                    break
+    
+    def _parquet_writer(self, output_file, schema):
+        # Codecs como snappy (e a ausência de compressão) não aceitam nível
+        compression_level = self.compression_level
+        if str(self.compression).lower() == 'none' or not pa.Codec.supports_compression_level(self.compression):
+            compression_level = None
+        return pq.ParquetWriter(
+            output_file,
+            schema,
+            compression=self.compression,
+            compression_level=compression_level,
+            use_dictionary=True
+        )
+    
+    def _write_parquet(self, batches, output_file, schema=None):
+        """Grava os RecordBatches em um arquivo Parquet sem passar pelo pandas"""
+        writer = self._parquet_writer(output_file, schema) if schema is not None else None
+        pending, pending_rows = [], 0
+        try:
+            for batch in batches:
+                if writer is None:
+                    writer = self._parquet_writer(output_file, batch.schema)
+                # Agrupa os lotes para gravar row groups de ROW_GROUP_SIZE linhas
+                pending.append(batch)
+                pending_rows += batch.num_rows
+                if pending_rows >= ROW_GROUP_SIZE:
+                    table = pa.Table.from_batches(pending)
+                    full_rows = pending_rows - pending_rows % ROW_GROUP_SIZE
+                    writer.write_table(table.slice(0, full_rows), row_group_size=ROW_GROUP_SIZE)
+                    pending = table.slice(full_rows).to_batches()
+                    pending_rows -= full_rows
+            if pending:
+                writer.write_table(pa.Table.from_batches(pending), row_group_size=ROW_GROUP_SIZE)
+        finally:
+            if writer is not None:
+                writer.close()
+    
+    def _write_arrow(self, batches, output_file, schema=None):
+        """Grava os RecordBatches em um arquivo Arrow IPC, lido depois sem desserialização"""
+        writer = pa.ipc.new_file(output_file, schema) if schema is not None else None
+        try:
+            for batch in batches:
+                if writer is None:
+                    writer = pa.ipc.new_file(output_file, batch.schema)
+                writer.write_batch(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+    
+    def _intermediate_file(self, path, name):
+        return path / f"{name}.{self.intermediate_format}"
+    
+    def _write_intermediate(self, batches, output_file, schema=None):
+        """Grava o arquivo intermediário de forma atômica e marca a extração como concluída"""
+        # Escreve em um temporário e renomeia ao final para nunca deixar um arquivo parcial
+        tmp_file = output_file.with_name(output_file.name + ".tmp")
+        try:
+            if self.intermediate_format == 'arrow':
+                self._write_arrow(batches, tmp_file, schema)
+            else:
+                self._write_parquet(batches, tmp_file, schema)
+        except BaseException:
+            tmp_file.unlink(missing_ok=True)
+            raise
+        
+        os.replace(tmp_file, output_file)
+        (output_file.parent / SUCCESS_MARKER).touch()
+    
+    def _open_dataset(self, path):
+        file_format = 'ipc' if path.suffix == '.arrow' else 'parquet'
+        # O arquivo é mapeado em memória e os lotes apontam direto para ele
+        return ds.dataset(str(path), format=file_format, filesystem=pafs.LocalFileSystem(use_mmap=True))
+    
+    def _read_intermediate(self, path, watermark=None):
+        """Abre o arquivo intermediário e retorna seu esquema e um iterador de lotes"""
+        dataset = self._open_dataset(path)
+        row_filter = None
+        if watermark is not None:
+            # No Parquet o filtro usa as estatísticas dos row groups para pular os que não servem
+            column_type = dataset.schema.field(WATERMARK_COLUMN).type
+            row_filter = ds.field(WATERMARK_COLUMN) >= pa.scalar(watermark, type=column_type)
+        return dataset.schema, dataset.to_batches(filter=row_filter, batch_size=COPY_BATCH_SIZE)
+    
+    def _ddl_fingerprint(self, table):
+        """Resume as colunas e os tipos da tabela para detectar mudanças no DDL"""
+        metadata = get_table_metadata(self.postgres_conn_string)[table]
+        return "|".join(f"{column}:{type_}" for column, type_ in zip(metadata['columns'], metadata['types']))
+    
+    def extract_one_table(self, table):
+        """Extrai uma tabela do PostgreSQL para o arquivo intermediário"""
+        try:
+            columns = ", ".join(f'"{column}"' for column in self.get_columns(table))
+            query = f"SELECT {columns} FROM {table}"
+            params = None
+            watermark = self.get_watermark(table) if self.is_incremental(table) else None
+            if watermark is not None:
+                # Linhas com a mesma marca d'água são extraídas de novo e resolvidas no upsert
+                # A ordenação agrupa as marcas d'água nos row groups e melhora o filtro na carga
+                query += f' WHERE "{WATERMARK_COLUMN}" >= %s ORDER BY "{WATERMARK_COLUMN}"'
+                params = (watermark,)
+                self.logger.info(f"Extraindo tabela: {table} (a partir de {watermark})")
+            else:
+                self.logger.info(f"Extraindo tabela: {table}")
+            
+            path = Path(f"data/postgres/{table}/{self.execution_date}")
+            path.mkdir(parents=True, exist_ok=True)
+            
+            output_file = self._intermediate_file(path, table)
+            conn = self.engine.raw_connection()
+            try:
+                batches = self._query_batches(conn, query, params)
+                self._write_intermediate(batches, output_file)
+            finally:
+                conn.close()
+            
+            return True
+        except Exception as e:
+            self.logger.error(f"Erro ao extrair a tabela {table}: {str(e)}")
+            return False
     
     def extract_from_postgres(self):
         """Extrai todas as tabelas do PostgreSQL"""
         try:
-            engine = create_engine(self.postgres_conn_string)
             tables = self.get_all_tables()
             
-            for table in tables:
-                self.logger.info(f"Extraindo tabela: {table}")
-                query = f"SELECT * FROM {table}"
-                df = pd.read_sql(query, engine)
-                
-                path = Path(f"data/postgres/{table}/{self.execution_date}")
-                path.mkdir(parents=True, exist_ok=True)
+            with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as executor:
+                results = list(executor.map(self.extract_one_table, tables))
                 
-                output_file = path / f"{table}.parquet"
-                df.to_parquet(output_file)
-                
-            return True
+            return all(results)
         except Exception as e:
             self.logger.error(f"Erro ao extrair do Postgres: {str(e)}")
             return False
@@ -65,103 +511,296 @@ class NorthwindETL:
     def extract_from_csv(self):
         """Extrai dados do arquivo CSV"""
         try:
-            df = pd.read_csv(self.csv_path)
-            
             path = Path(f"data/csv/{self.execution_date}")
             path.mkdir(parents=True, exist_ok=True)
             
-            output_file = path / "order_details.parquet"
-            df.to_parquet(output_file)
+            # Leitura em fluxo: só um bloco de CSV_BLOCK_SIZE fica em memória por vez
+            output_file = self._intermediate_file(path, CSV_TABLE)
+            with pacsv.open_csv(
+                self.csv_path,
+                read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE, use_threads=True),
+                convert_options=pacsv.ConvertOptions(column_types=ORDER_DETAILS_SCHEMA)
+            ) as reader:
+                self._write_intermediate(reader, output_file, reader.schema)
             
             return True
         except Exception as e:
             self.logger.error(f"Erro ao extrair do CSV: {str(e)}")
             return False
             
+    def check_sources(self):
+        """Verifica se o arquivo CSV existe e se o Postgres responde"""
+        if not Path(self.csv_path).is_file():
+            self.logger.error(f"Arquivo CSV não encontrado: {self.csv_path}")
+            return False
+        try:
+            with self.engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            return True
+        except Exception as e:
+            self.logger.error(f"Postgres indisponível: {str(e)}")
+            return False
+    
+    def has_new_data(self):
+        """Verifica se há dados novos no Postgres ou no CSV desde a última carga"""
+        for table in self.get_all_tables():
+            # Tabelas sem marca d'água não têm como indicar mudanças e são sempre extraídas
+            if not self.is_incremental(table):
+                return True
+            watermark = self.get_watermark(table)
+            if watermark is None:
+                return True
+            query = text(f'SELECT 1 FROM {table} WHERE "{WATERMARK_COLUMN}" > :watermark LIMIT 1')
+            with self.engine.connect() as conn:
+                if conn.execute(query, {'watermark': watermark}).first() is not None:
+                    return True
+        
+        markers = list(Path("data/csv").glob(f"*/{SUCCESS_MARKER}"))
+        if not markers or Path(self.csv_path).stat().st_mtime > max(m.stat().st_mtime for m in markers):
+            return True
+        
+        self.logger.info("Nenhum dado novo desde a última carga")
+        return False
+    
     def check_extract_success(self):
         """Verifica se ambas as extrações foram bem-sucedidas"""
-        postgres_files = list(Path(f"data/postgres").glob(f"*/{self.execution_date}/*.parquet"))
-        csv_files = list(Path(f"data/csv/{self.execution_date}").glob("*.parquet"))
+        postgres_files = list(Path(f"data/postgres").glob(f"*/{self.execution_date}/{SUCCESS_MARKER}"))
+        csv_files = list(Path(f"data/csv/{self.execution_date}").glob(SUCCESS_MARKER))
         
         return len(postgres_files) > 0 and len(csv_files) > 0
     
+    def _create_table(self, cursor, schema, table, primary_key=None):
+        """Recria a tabela a partir do esquema do Arrow"""
+        columns = [f'"{field.name}" {postgres_type(field.type)}' for field in schema]
+        if primary_key:
+            columns.append("PRIMARY KEY (" + ", ".join(f'"{column}"' for column in primary_key) + ")")
+        # A antiga view orders_complete depende das tabelas finais e impediria o DROP
+        cursor.execute(DROP_LEGACY_VIEW)
+        cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        cursor.execute(f"CREATE TABLE {table} ({', '.join(columns)})")
+    
+    def _load_batches(self, cursor, schema, batches, table):
+        """Envia os lotes para a tabela e retorna a maior marca d'água encontrada"""
+        names = schema.names
+        columns = ", ".join(f'"{name}"' for name in names)
+        watermark = None
+        for batch in batches:
+            if self.load_method == 'insert':
+                rows = list(zip(*batch.to_pydict().values()))
+                psycopg2.extras.execute_values(
+                    cursor, f"INSERT INTO {table} ({columns}) VALUES %s", rows, page_size=INSERT_PAGE_SIZE
+                )
+            else:
+                buffer = io.BytesIO()
+                pacsv.write_csv(copy_batch(batch), buffer, pacsv.WriteOptions(include_header=False))
+                buffer.seek(0)
+                cursor.copy_expert(f"COPY {table} ({columns}) FROM STDIN WITH CSV", buffer)
+            
+            if WATERMARK_COLUMN in names:
+                batch_max = pc.max(batch.column(WATERMARK_COLUMN)).as_py()
+                if batch_max is not None and (watermark is None or batch_max > watermark):
+                    watermark = batch_max
+        return watermark
+    
+    def _copy_to_table(self, path, table, source_table=None):
+        """Carrega o arquivo intermediário, substituindo a tabela ou fazendo upsert incremental"""
+        primary_key = []
+        current_watermark = None
+        if source_table is not None and self.is_incremental(source_table):
+            primary_key = self.get_primary_key(source_table)
+            current_watermark = self.get_watermark(source_table)
+        # Sem marca d'água registrada a extração foi completa e a tabela é recriada
+        upsert = len(primary_key) > 0 and current_watermark is not None
+        # No upsert, linhas anteriores à marca atual já foram carregadas por uma execução
+        # mais recente e não são relidas, para não sobrescrever versões mais novas
+        schema, batches = self._read_intermediate(path, current_watermark if upsert else None)
+        
+        conn = self.engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                if upsert:
+                    stage = f"{table}_stage"
+                    cursor.execute(f"CREATE TEMP TABLE {stage} (LIKE {table}) ON COMMIT DROP")
+                    watermark = self._load_batches(cursor, schema, batches, stage)
+                    
+                    names = schema.names
+                    columns = ", ".join(f'"{name}"' for name in names)
+                    key = ", ".join(f'"{column}"' for column in primary_key)
+                    updates = ", ".join(f'"{name}" = EXCLUDED."{name}"' for name in names if name not in primary_key)
+                    action = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+                    cursor.execute(
+                        f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {stage} "
+                        f"ON CONFLICT ({key}) {action}"
+                    )
+                else:
+                    self._create_table(cursor, schema, table, primary_key)
+                    watermark = self._load_batches(cursor, schema, batches, table)
+                
+                if primary_key and watermark is not None:
+                    self._set_watermark(cursor, source_table, watermark)
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def load_one_table(self, table):
+        """Carrega uma tabela extraída do Postgres na tabela final"""
+        try:
+            # Extrações antigas de order_details não podem concorrer com a carga do CSV
+            if table == CSV_TABLE:
+                self.logger.info(f"Tabela {table} é carregada a partir do CSV")
+                return True
+            
+            table_final = table.replace('_final', '') + '_final'
+            path = Path(f"data/postgres/{table}/{self.execution_date}")
+            file_path = self._intermediate_file(path, table)
+            if not (path / SUCCESS_MARKER).exists():
+                self.logger.error(f"Extração da tabela {table} não foi concluída")
+                return False
+            
+            self.logger.info(f"Carregando tabela: {table_final}")
+            self._copy_to_table(file_path, table_final, table)
+            return True
+        except Exception as e:
+            self.logger.error(f"Erro ao carregar a tabela {table}: {str(e)}")
+            return False
+    
+    def load_from_csv(self):
+        """Carrega os dados extraídos do CSV na tabela order_details_final"""
+        try:
+            path = Path(f"data/csv/{self.execution_date}")
+            csv_file = self._intermediate_file(path, CSV_TABLE)
+            if (path / SUCCESS_MARKER).exists():
+                self._copy_to_table(csv_file, f'{CSV_TABLE}_final')
+            return True
+        except Exception as e:
+            self.logger.error(f"Erro ao carregar o CSV: {str(e)}")
+            return False
+    
+    def create_orders_complete(self):
+        """Cria orders_complete se as tabelas finais necessárias existirem"""
+        try:
+            with self.engine.connect() as conn:
+                tables = conn.execute(text("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'")).scalars().all()
+            if 'orders_final' in tables and 'order_details_final' in tables:
+                self.materialize_orders_complete()
+                self.logger.info("Tabela orders_complete criada com sucesso")
+                return True
+            self.logger.error("Tabelas necessárias não encontradas")
+            return False
+        except Exception as e:
+            self.logger.error(f"Erro ao criar orders_complete: {str(e)}")
+            return False
+    
     def load_to_postgres(self):
         """Carrega dados para o PostgreSQL final"""
         if not self.check_extract_success():
             self.logger.error("Arquivos de extração não encontrados. Execute a etapa 1 primeiro.")
             return False
             
-        try:
-            engine = create_engine(self.postgres_conn_string)
-            
-            # Carregar todas as tabelas do Postgres
-            postgres_path = Path(f"data/postgres")
-            for table_path in postgres_path.glob("*"):
-                table_name = table_path.name
-                table_name_final = table_name.replace('_final', '') + '_final'
-                file_path = table_path / self.execution_date / f"{table_name}.parquet"
-                
-                if file_path.exists():
-                    df = pd.read_parquet(file_path)
-                    df.to_sql(table_name_final, engine, if_exists='replace', index=False)
-            
-            # Carregar dados do CSV
-            csv_file = Path(f"data/csv/{self.execution_date}/order_details.parquet")
-            if csv_file.exists():
-                df = pd.read_parquet(csv_file)
-                df.to_sql('order_details_final', engine, if_exists='replace', index=False)
-            
-            # Verificar se as tabelas existem antes de criar a view
-            with engine.connect() as conn:
-                tables = pd.read_sql("SELECT table_name FROM information_schema.tables WHERE table_schema = 'public'", conn)
-                if 'orders_final' in tables['table_name'].values and 'order_details_final' in tables['table_name'].values:
-                    self.create_combined_view()
-                    self.logger.info("View orders_complete criada com sucesso")
-                else:
-                    self.logger.error("Tabelas necessárias não encontradas")
-                    return False
-            return True
+        # Carregar todas as tabelas do Postgres
+        postgres_path = Path(f"data/postgres")
+        for table_path in postgres_path.glob("*"):
+            table_name = table_path.name
+            marker = table_path / self.execution_date / SUCCESS_MARKER
             
-        except Exception as e:
-            self.logger.error(f"Erro ao carregar para o Postgres: {str(e)}")
+            if marker.exists() and not self.load_one_table(table_name):
+                return False
+        
+        # Carregar dados do CSV
+        if not self.load_from_csv():
             return False
+        
+        # Com o DuckDB a junção é feita só na exportação, direto sobre os arquivos extraídos
+        if self.exports_with_duckdb():
+            return True
+        
+        return self.create_orders_complete()
             
-    def create_combined_view(self):
-        """Cria view combinando pedidos e detalhes"""
-        engine = create_engine(self.postgres_conn_string)
-        query = """
-        CREATE OR REPLACE VIEW public.orders_complete AS
-        SELECT 
-            o.*,
-            d.product_id,
-            d.unit_price,
-            d.quantity,
-            d.discount
-        FROM public.orders_final o
-        JOIN public.order_details_final d ON o.order_id = d.order_id;
-        """
-        with engine.connect() as conn:
-            conn.execute(text(query))
+    def materialize_orders_complete(self):
+        """Materializa a tabela orders_complete combinando pedidos e detalhes"""
+        with self.engine.connect() as conn:
+            conn.execute(text("CREATE INDEX IF NOT EXISTS orders_final_order_id_idx ON public.orders_final (order_id)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS order_details_final_order_id_idx ON public.order_details_final (order_id)"))
+            conn.execute(text(DROP_LEGACY_VIEW))
+            conn.execute(text("DROP TABLE IF EXISTS public.orders_complete"))
+            select = ORDERS_COMPLETE_SELECT.format(
+                orders='public.orders_final', order_details='public.order_details_final'
+            )
+            conn.execute(text(f"CREATE TABLE public.orders_complete AS {select}"))
             conn.commit()
             
+    def _write_results(self, batches):
+        """Grava os lotes de orders_complete em CSV, JSON (um registro por linha) e Parquet"""
+        # Os dois motores passam pelo mesmo serializador e geram arquivos idênticos
+        results_dir = Path("results")
+        results_dir.mkdir(exist_ok=True)
+        
+        output = f"results/orders_complete_{self.execution_date}"
+        csv_writer = parquet_writer = None
+        try:
+            with open(f"{output}.json", "wb") as json_output:
+                for batch in batches:
+                    if csv_writer is None:
+                        csv_writer = pacsv.CSVWriter(f"{output}.csv", copy_batch(batch).schema)
+                        parquet_writer = self._parquet_writer(f"{output}.parquet", batch.schema)
+                    csv_writer.write_batch(copy_batch(batch))
+                    parquet_writer.write_batch(batch)
+                    json_output.writelines(json_lines(batch))
+        finally:
+            if csv_writer is not None:
+                csv_writer.close()
+                parquet_writer.close()
+    
+    def _export_with_duckdb(self):
+        """Faz a junção com o DuckDB direto sobre os arquivos extraídos e exporta os resultados"""
+        orders_path = Path(f"data/postgres/orders/{self.execution_date}")
+        details_path = Path(f"data/csv/{self.execution_date}")
+        if not (orders_path / SUCCESS_MARKER).exists() or not (details_path / SUCCESS_MARKER).exists():
+            self.logger.error("Arquivos de extração não encontrados. Execute a etapa 1 primeiro.")
+            return False
+        
+        import duckdb
+        
+        con = duckdb.connect()
+        try:
+            # Timestamps com fuso saem em UTC, como na leitura do Postgres
+            con.execute("SET TimeZone = 'UTC'")
+            con.register('orders', self._open_dataset(self._intermediate_file(orders_path, "orders")))
+            con.register('order_details', self._open_dataset(self._intermediate_file(details_path, CSV_TABLE)))
+            select = ORDERS_COMPLETE_SELECT.format(orders='orders', order_details='order_details')
+            self._write_results(con.execute(select).fetch_record_batch(COPY_BATCH_SIZE))
+        finally:
+            con.close()
+        return True
+    
+    def _export_with_postgres(self):
+        """Exporta a tabela orders_complete do Postgres"""
+        conn = self.engine.raw_connection()
+        try:
+            self._write_results(self._query_batches(conn, "SELECT * FROM public.orders_complete"))
+        finally:
+            conn.close()
+        return True
+    
+    def exports_with_duckdb(self):
+        """Indica se a exportação é feita pelo DuckDB em vez da tabela orders_complete do Postgres"""
+        # Extrações incrementais só trazem as linhas alteradas de orders e não servem para a junção
+        return self.export_engine == 'duckdb' and not self.is_incremental('orders')
+    
     def export_results(self):
-        """Exporta resultados da consulta final"""
+        """Exporta resultados da consulta final em CSV, JSON (um registro por linha) e Parquet"""
         try:
-            engine = create_engine(self.postgres_conn_string)
-            
-            # Recriar a view para garantir que existe
-            self.create_combined_view()
+            if self.exports_with_duckdb():
+                exported = self._export_with_duckdb()
+            else:
+                exported = self._export_with_postgres()
             
-            query = "SELECT * FROM orders_complete"
-            results_dir = Path("results")
-            results_dir.mkdir(exist_ok=True)
-            
-            df = pd.read_sql(query, engine)
-            df.to_csv(f"results/orders_complete_{self.execution_date}.csv", index=False)
-            df.to_json(f"results/orders_complete_{self.execution_date}.json", orient='records')
-            self.logger.info("Resultados exportados com sucesso")
+            if exported:
+                self.logger.info("Resultados exportados com sucesso")
+            return exported
         except Exception as e:
             self.logger.error(f"Erro ao exportar resultados: {str(e)}")
+            return False
 
 def main():
     parser = argparse.ArgumentParser(description='Northwind ETL Pipeline')
@@ -170,10 +809,18 @@ def main():
     parser.add_argument('--csv-path', required=True, help='Caminho do arquivo CSV')
     parser.add_argument('--step', choices=['extract', 'load', 'all'], default='all',
                        help='Etapa a ser executada')
+    parser.add_argument('--intermediate-format', choices=INTERMEDIATE_FORMATS, default='parquet',
+                       help='Formato dos arquivos entre extração e carga')
+    parser.add_argument('--load-method', choices=LOAD_METHODS, default='copy',
+                       help='Método de carga no PostgreSQL')
+    parser.add_argument('--export-engine', choices=EXPORT_ENGINES, default='postgres',
+                       help='Motor usado para gerar os resultados')
     
     args = parser.parse_args()
     
-    etl = NorthwindETL(args.postgres_conn, args.csv_path, args.date)
+    etl = NorthwindETL(args.postgres_conn, args.csv_path, args.date,
+                       intermediate_format=args.intermediate_format, load_method=args.load_method,
+                       export_engine=args.export_engine)
     
     if args.step in ['extract', 'all']:
         postgres_success = etl.extract_from_postgres()